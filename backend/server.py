@@ -1,17 +1,23 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
-from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from cachetools import TTLCache
 import os
+import re
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Dict, List, Optional, Set, Tuple
 import uuid
-from datetime import datetime
-import httpx
-import json
-import asyncio
+from datetime import datetime, timedelta, timezone
+import aiohttp
+import orjson
+import hashlib
+import gzip
+import time
 import asyncio
 
 
@@ -20,11 +26,53 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# zstd is preferred; zlib is always available as a compressed fallback
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=100,
+    minPoolSize=10,
+    compressors="zstd,zlib",
+    zlibCompressionLevel=3,
+    # Return aware UTC datetimes so stored timestamps compare with datetime.now(timezone.utc)
+    tz_aware=True
+)
 db = client[os.environ['DB_NAME']]
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared HTTP session so connections to the HF inference host are kept alive
+    app.state.hf_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=40, keepalive_timeout=30),
+        timeout=aiohttp.ClientTimeout(total=HF_TIMEOUT_SECONDS)
+    )
+    # Queues and semaphores bind to the loop that first waits on them, so each lifespan builds its own
+    app.state.hf_sem = asyncio.Semaphore(MAX_HF_INFLIGHT)
+    app.state.hf_batch_queue = asyncio.Queue()
+    app.state.history_queue = asyncio.Queue()
+    app.state.status_queue = asyncio.Queue()
+    await create_db_indexes()
+    app.state.hf_batch_task = asyncio.create_task(hf_batch_worker(app.state.hf_batch_queue, app.state.hf_session))
+    app.state.hf_batch_task.add_done_callback(log_background_failure)
+    app.state.history_task = asyncio.create_task(batch_writer(app.state.history_queue, db.documentation_history))
+    app.state.status_task = asyncio.create_task(batch_writer(app.state.status_queue, db.status_checks))
+    
+    yield
+    
+    app.state.hf_batch_task.cancel()
+    # Let in-flight batch dispatches and cache upserts finish; they must not outlive the HF session
+    if background_tasks:
+        await asyncio.wait(list(background_tasks), timeout=SHUTDOWN_TIMEOUT_SECONDS)
+        for task in list(background_tasks):
+            task.cancel()
+    # Writers drain everything queued ahead of the sentinel before exiting
+    app.state.history_queue.put_nowait(None)
+    app.state.status_queue.put_nowait(None)
+    await asyncio.gather(app.state.history_task, app.state.status_task)
+    await app.state.hf_session.close()
+    client.close()
+
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -33,6 +81,14 @@ api_router = APIRouter(prefix="/api")
 HF_API_KEY = os.getenv('HUGGING_FACE_API_KEY', '')
 HF_MODEL_URL = "https://api-inference.huggingface.co/models/microsoft/CodeBERT-base"
 
+# Request headers built once; bodies are pre-serialized bytes, so Content-Type is set explicitly
+HF_AUTH_HEADERS = {"Authorization": f"Bearer {HF_API_KEY}"}
+HF_HEADERS = {**HF_AUTH_HEADERS, "Content-Type": "application/json"}
+HF_GZIP_HEADERS = {**HF_HEADERS, "Content-Encoding": "gzip"}
+
+# Model metadata endpoint used for status checks without running inference
+HF_MODEL_INFO_URL = "https://huggingface.co/api/models/" + HF_MODEL_URL.split("/models/", 1)[1]
+
 # Alternative models to try if primary fails
 FALLBACK_MODELS = [
     "https://api-inference.huggingface.co/models/microsoft/codebert-base-mlm",
@@ -40,17 +96,88 @@ FALLBACK_MODELS = [
     "https://api-inference.huggingface.co/models/microsoft/DialoGPT-medium"
 ]
 
+# How long an attempt may run before the next fallback model is started alongside it.
+# Sized to the primary model's normal latency so a healthy primary answers alone.
+HF_HEDGE_SECONDS = float(os.getenv('HF_HEDGE_SECONDS', '10'))
+
+# Overall budget for all model attempts before falling back to rule-based documentation
+HF_DEADLINE_SECONDS = float(os.getenv('HF_DEADLINE_SECONDS', '60'))
+
+# Total time allowed for one HF request, including a wait on a batched primary-model request
+HF_TIMEOUT_SECONDS = 30
+
+# Upper bound on concurrent HF requests. Lower values avoid HF 429s and bound
+# memory, at the cost of queueing bursts locally.
+MAX_HF_INFLIGHT = int(os.getenv('MAX_HF_INFLIGHT', '16'))
+
+# Time allowed for in-flight background tasks to finish at shutdown
+SHUTDOWN_TIMEOUT_SECONDS = 5.0
+
+# Retries for a loading (503) model before moving on to other models
+HF_LOADING_RETRIES = 3
+
+# How long an /llm-status result is reused
+LLM_STATUS_TTL_SECONDS = 30.0
+llm_status_cache = {"expires": 0.0, "value": None}
+
+# Request bodies larger than this are gzip-compressed before upload
+GZIP_MIN_BYTES = 1024
+
+# Generation parameters shared by single and batched inference requests
+HF_PARAMETERS = {
+    "max_length": 1000,
+    "temperature": 0.7,
+    "do_sample": True,
+    "top_p": 0.9,
+    "return_full_text": False
+}
+
+# Extractors for each known HF response format, keyed by shape name
+RESPONSE_EXTRACTORS = {
+    "list_dict": (list, lambda result: result[0]['generated_text']),
+    "list_str": (list, lambda result: result[0]),
+    "dict": (dict, lambda result: result['generated_text']),
+    "str": (str, lambda result: result)
+}
+
+# Response format detected per model URL
+response_shapes: Dict[str, str] = {}
+
+# Micro-batching of concurrent requests to the primary model
+BATCH_WINDOW_MS = int(os.getenv('BATCH_WINDOW_MS', '50'))
+MAX_BATCH = int(os.getenv('MAX_BATCH', '8'))
+
+# Documentation cache configuration (default: 7 days)
+CACHE_TTL_SECONDS = int(os.getenv('CACHE_TTL_SECONDS', str(7 * 24 * 60 * 60)))
+
+# In-process cache in front of the Mongo documentation cache, storing (documentation, expiry)
+MEMORY_CACHE_SIZE = 512
+memory_cache: TTLCache = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=CACHE_TTL_SECONDS)
+
+# Strong references to fire-and-forget tasks until they complete
+background_tasks: Set[asyncio.Task] = set()
+
+# History and status records are queued and written with insert_many.
+# Writes are acknowledged before they reach Mongo, so a crash can drop up to one window of records.
+WRITE_BATCH_SIZE = 100
+WRITE_BATCH_WINDOW_MS = 50
+
+# In-flight documentation generations keyed by cache key
+inflight_requests: Dict[str, asyncio.Future] = {}
+
 
 # Define Models
 class StatusCheck(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     client_name: str
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class StatusCheckCreate(BaseModel):
     client_name: str
 
 class DocumentationRequest(BaseModel):
+    model_config = ConfigDict(str_max_length=1_000_000)
+    
     jcl_code: Optional[str] = None
     proc_code: Optional[str] = None
     program_code: str
@@ -67,100 +194,242 @@ async def root():
 
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
-    status_dict = input.dict()
-    status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
+    status_obj = StatusCheck(client_name=input.client_name)
+    app.state.status_queue.put_nowait(status_obj.model_dump())
     return status_obj
 
 @api_router.get("/status", response_model=List[StatusCheck])
 async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
-    return [StatusCheck(**status_check) for status_check in status_checks]
-
-async def call_hugging_face_api(prompt: str, model_url: str = HF_MODEL_URL) -> str:
-    """Call Hugging Face Inference API with multiple model fallbacks"""
-    headers = {
-        "Authorization": f"Bearer {HF_API_KEY}",
-        "Content-Type": "application/json"
+    cursor = db.status_checks.find(
+        {},
+        projection={"_id": 0, "id": 1, "client_name": 1, "timestamp": 1}
+    ).sort("timestamp", -1).limit(1000)
+    # Documents were validated on insert, so skip re-validation when reading
+    return [StatusCheck.model_construct(**status_check) async for status_check in cursor]
+
+async def post_once(session: aiohttp.ClientSession, model: str, headers: dict, body: bytes) -> Tuple[int, bytes]:
+    """POST a pre-encoded body and return the status code and raw response body"""
+    # Cap concurrent HF calls; backoff sleeps happen outside the semaphore
+    async with app.state.hf_sem:
+        async with session.post(model, headers=headers, data=body) as response:
+            return response.status, await response.read()
+
+async def post_to_hugging_face(session: aiohttp.ClientSession, model: str, payload: dict) -> Tuple[int, bytes]:
+    """POST an inference payload to a Hugging Face model, retrying while it loads"""
+    headers = HF_HEADERS
+    
+    body = orjson.dumps(payload)
+    # Compress larger bodies; tiny payloads are not worth the CPU
+    if len(body) > GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=3)
+        headers = HF_GZIP_HEADERS
+    
+    status, content = await post_once(session, model, headers, body)
+    
+    logging.info(f"HF API Response Status: {status}")
+    
+    # Model is loading, retry with exponential backoff (1s, 2s, 4s)
+    for attempt in range(HF_LOADING_RETRIES):
+        if status != 503:
+            break
+        logging.info(f"Model loading, retrying in {2 ** attempt} seconds...")
+        await asyncio.sleep(2 ** attempt)
+        status, content = await post_once(session, model, headers, body)
+    
+    return status, content
+
+def detect_response_shape(result) -> Optional[str]:
+    """Identify which of the HF response formats a result uses"""
+    if isinstance(result, list) and len(result) > 0:
+        if isinstance(result[0], dict) and 'generated_text' in result[0]:
+            return "list_dict"
+        elif isinstance(result[0], str):
+            return "list_str"
+    elif isinstance(result, dict) and 'generated_text' in result:
+        return "dict"
+    elif isinstance(result, str):
+        return "str"
+    return None
+
+def extract_generated_text(result, model: str) -> Optional[str]:
+    """Extract generated text using the shape last seen for this model"""
+    shape = response_shapes.get(model)
+    if shape is not None:
+        container, extractor = RESPONSE_EXTRACTORS[shape]
+        if type(result) is container:
+            try:
+                generated_text = extractor(result)
+                if isinstance(generated_text, str):
+                    return generated_text
+            except (KeyError, IndexError, TypeError):
+                pass
+    
+    # Unknown or changed format, probe it and remember for next time
+    shape = detect_response_shape(result)
+    if shape is None:
+        return None
+    response_shapes[model] = shape
+    return RESPONSE_EXTRACTORS[shape][1](result)
+
+async def hf_batch_worker(queue: asyncio.Queue, session: aiohttp.ClientSession):
+    """Coalesce concurrent prompts for the primary model into batched HF requests"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_MS / 1000
+        
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        # Dispatch without blocking collection of the next batch
+        fire_and_forget(dispatch_hf_batch(session, batch))
+
+async def dispatch_hf_batch(session: aiohttp.ClientSession, batch: list):
+    """Send one batched HF request and fan the results back to the waiting callers"""
+    # Skip callers that were cancelled or already got an answer elsewhere
+    batch = [(prompt, future) for prompt, future in batch if not future.done()]
+    if not batch:
+        return
+    
+    prompts = [prompt for prompt, _ in batch]
+    payload = {
+        # A single prompt keeps the plain string input format
+        "inputs": prompts[0] if len(prompts) == 1 else prompts,
+        "parameters": HF_PARAMETERS
     }
     
+    try:
+        logging.info(f"Sending batch of {len(batch)} prompt(s) to {HF_MODEL_URL}")
+        status, content = await post_to_hugging_face(session, HF_MODEL_URL, payload)
+        
+        if status != 200:
+            logging.debug("HF API error body from %s: %r", HF_MODEL_URL, content[:200])
+            raise Exception(f"HF API error: {status}")
+        
+        result = orjson.loads(content)
+        results = [result] if len(batch) == 1 else result
+        if not isinstance(results, list) or len(results) != len(batch):
+            raise Exception("Unexpected batched response format")
+        
+        for (_, future), item in zip(batch, results):
+            if not future.done():
+                future.set_result(item)
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+
+async def try_hugging_face_model(
+    prompt: str,
+    payload: dict,
+    session: aiohttp.ClientSession,
+    model: str
+) -> Optional[str]:
+    """Attempt documentation generation with a single model"""
+    try:
+        logging.info(f"Trying Hugging Face model: {model}")
+        
+        if model == HF_MODEL_URL:
+            # Primary model requests are micro-batched across concurrent callers
+            future = asyncio.get_running_loop().create_future()
+            await app.state.hf_batch_queue.put((payload["inputs"], future))
+            # Fail over to the fallback models if the batch never resolves this caller
+            result = await asyncio.wait_for(future, HF_TIMEOUT_SECONDS)
+        else:
+            status, content = await post_to_hugging_face(session, model, payload)
+            if status != 200:
+                logging.error("HF API error with %s: %s", model, status)
+                logging.debug("HF API error body from %s: %r", model, content[:200])
+                return None
+            result = orjson.loads(content)
+        
+        logging.info(f"HF API Success with model: {model}")
+        
+        generated_text = extract_generated_text(result, model)
+        if generated_text is not None:
+            return format_llm_response(generated_text, prompt)
+            
+    except Exception as e:
+        logging.error(f"Error calling HF API with {model}: {str(e)}")
+    
+    return None
+
+async def call_hugging_face_api(
+    prompt: str,
+    session: aiohttp.ClientSession,
+    model_url: str = HF_MODEL_URL
+) -> Tuple[str, Optional[str]]:
+    """Call Hugging Face Inference API with multiple model fallbacks, returning (documentation, model)"""
+    
     # Shortened prompt for better LLM performance
     short_prompt = f"Generate mainframe documentation for: {prompt[:500]}..."
     
     payload = {
         "inputs": short_prompt,
-        "parameters": {
-            "max_length": 1000,
-            "temperature": 0.7,
-            "do_sample": True,
-            "top_p": 0.9,
-            "return_full_text": False
-        }
+        "parameters": HF_PARAMETERS
     }
     
-    # Try primary model and fallbacks
-    models_to_try = [model_url] + FALLBACK_MODELS
-    
-    for model in models_to_try:
-        try:
-            logging.info(f"Trying Hugging Face model: {model}")
-            
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(model, headers=headers, json=payload)
-                
-                logging.info(f"HF API Response Status: {response.status_code}")
-                
-                if response.status_code == 503:
-                    # Model is loading, wait and retry once
-                    logging.info("Model loading, waiting 20 seconds...")
-                    await asyncio.sleep(20)
-                    response = await client.post(model, headers=headers, json=payload)
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    logging.info(f"HF API Success with model: {model}")
-                    
-                    # Handle different response formats
-                    if isinstance(result, list) and len(result) > 0:
-                        if 'generated_text' in result[0]:
-                            generated_text = result[0]['generated_text']
-                            return format_llm_response(generated_text, prompt)
-                        elif isinstance(result[0], str):
-                            return format_llm_response(result[0], prompt)
-                    elif isinstance(result, dict) and 'generated_text' in result:
-                        return format_llm_response(result['generated_text'], prompt)
-                    elif isinstance(result, str):
-                        return format_llm_response(result, prompt)
+    # Start the next model only when an attempt fails or the hedge delay elapses
+    models = iter([model_url] + FALLBACK_MODELS)
+    order = {}
+    pending = set()
+    try:
+        async with asyncio.timeout(HF_DEADLINE_SECONDS):
+            while True:
+                model = next(models, None)
+                if model is not None:
+                    task = asyncio.create_task(try_hugging_face_model(prompt, payload, session, model))
+                    order[task] = (len(order), model)
+                    pending.add(task)
+                if not pending:
+                    break
                 
-                else:
-                    logging.error(f"HF API error with {model}: {response.status_code} - {response.text}")
-                    
-        except Exception as e:
-            logging.error(f"Error calling HF API with {model}: {str(e)}")
-            continue
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=HF_HEDGE_SECONDS,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                # Prefer the earliest model in the list when several finish together
+                successes = sorted((order[task], task.result()) for task in done if task.result() is not None)
+                if successes:
+                    (_, model), documentation = successes[0]
+                    return documentation, model
+    except TimeoutError:
+        logging.warning(f"Hugging Face models did not answer within {HF_DEADLINE_SECONDS}s")
+    finally:
+        for task in order:
+            task.cancel()
     
     # All models failed, use fallback
     logging.warning("All Hugging Face models failed, using rule-based fallback")
-    return generate_fallback_documentation(prompt)
+    return await asyncio.to_thread(generate_fallback_documentation, prompt), None
 
 def format_llm_response(generated_text: str, original_prompt: str) -> str:
     """Format LLM response into proper documentation structure"""
     
-    # If the response looks like proper documentation, use it
-    if "1. Overview" in generated_text or "Overview" in generated_text:
+    # If the response looks like proper documentation, use it ("1. Overview" is covered too)
+    if "Overview" in generated_text:
         return f"=== AI-GENERATED MAINFRAME DOCUMENTATION ===\n\n{generated_text}"
     
     # Otherwise, structure it properly
+    overview = generated_text[:300]
+    insights = generated_text[300:600] or "Additional analysis and recommendations based on code patterns."
     structured_doc = f"""=== AI-GENERATED MAINFRAME DOCUMENTATION ===
 
 1. Overview
-{generated_text[:300]}...
+{overview}...
 
 2. Analysis
 The LLM has analyzed the provided mainframe code and generated insights about its functionality and structure.
 
 3. AI Insights
-{generated_text[300:600] if len(generated_text) > 300 else "Additional analysis and recommendations based on code patterns."}
+{insights}
 
 4. Recommendations
 - Review the generated analysis for accuracy
@@ -171,30 +440,16 @@ The LLM has analyzed the provided mainframe code and generated insights about it
 """
     return structured_doc
 
-def generate_fallback_documentation(prompt: str) -> str:
-    """Enhanced fallback documentation generator when LLM is unavailable"""
-    
-    # Extract program details from prompt
-    lines = prompt.split('\n')
-    program_name = "MAINFRAME-PROGRAM"
-    has_jcl = "JCL CODE:" in prompt
-    has_proc = "PROC CODE:" in prompt
-    
-    # Try to extract program ID
-    for line in lines:
-        if "PROGRAM-ID." in line:
-            parts = line.split("PROGRAM-ID.")
-            if len(parts) > 1:
-                program_name = parts[1].strip().split()[0]
-            break
-    
-    documentation = f"""=== MAINFRAME DOCUMENTATION (RULE-BASED ANALYSIS) ===
+# Program name following the first PROGRAM-ID. on the same line
+PROGRAM_ID_RE = re.compile(r"PROGRAM-ID\.[ \t]*(\S+)")
+
+FALLBACK_DOC_TEMPLATE = """=== MAINFRAME DOCUMENTATION (RULE-BASED ANALYSIS) ===
 
 1. Overview
 Program {program_name} is a mainframe batch processing application that handles data transformation and business logic operations. The program follows standard COBOL/Assembly programming practices and integrates with enterprise data processing workflows.
 
-2. Job Flow{" (JCL Detected)" if has_jcl else ""}
-{"The job is initiated through JCL (Job Control Language) which manages resource allocation and execution sequence. " if has_jcl else ""}{"PROC procedures are utilized for standardized job step execution. " if has_proc else ""}The execution follows these stages:
+2. Job Flow{jcl_note}
+{jcl_flow}{proc_flow}The execution follows these stages:
 - System resource allocation and dataset binding
 - Program compilation and linking (if required)  
 - Main program execution with parameter passing
@@ -253,26 +508,36 @@ Recommendation: Enhance with LLM analysis when available
 
 (Note: This is rule-based analysis. For enhanced AI-powered documentation, configure Hugging Face API key)
 """
-    return documentation
 
-def create_documentation_prompt(jcl_code: str, proc_code: str, program_code: str) -> str:
-    """Create a structured prompt for LLM documentation generation"""
+def generate_fallback_documentation(prompt: str) -> str:
+    """Enhanced fallback documentation generator when LLM is unavailable"""
+    
+    # Extract program details from prompt
+    match = PROGRAM_ID_RE.search(prompt)
+    program_name = match.group(1) if match else "MAINFRAME-PROGRAM"
+    has_jcl = "JCL CODE:" in prompt
+    has_proc = "PROC CODE:" in prompt
     
-    prompt = """You are a mainframe documentation expert. Analyze the provided mainframe code and generate comprehensive technical documentation.
+    return FALLBACK_DOC_TEMPLATE.format(
+        program_name=program_name,
+        jcl_note=" (JCL Detected)" if has_jcl else "",
+        jcl_flow="The job is initiated through JCL (Job Control Language) which manages resource allocation and execution sequence. " if has_jcl else "",
+        proc_flow="PROC procedures are utilized for standardized job step execution. " if has_proc else ""
+    )
+
+# Fallback documentation with no program details, used on the error path
+DEFAULT_FALLBACK_DOC = generate_fallback_documentation("")
+
+# Program source beyond this size is truncated before prompting
+MAX_CODE_BYTES = 32 * 1024
+
+PROMPT_HEADER = """You are a mainframe documentation expert. Analyze the provided mainframe code and generate comprehensive technical documentation.
 
 MAINFRAME CODE TO ANALYZE:
 
 """
-    
-    if jcl_code and jcl_code.strip():
-        prompt += f"JCL CODE:\n{jcl_code}\n\n"
-    
-    if proc_code and proc_code.strip():
-        prompt += f"PROC CODE:\n{proc_code}\n\n"
-    
-    prompt += f"PROGRAM CODE:\n{program_code}\n\n"
-    
-    prompt += """GENERATE DOCUMENTATION IN THIS EXACT FORMAT:
+
+PROMPT_FOOTER = """GENERATE DOCUMENTATION IN THIS EXACT FORMAT:
 
 1. Overview
 [Brief but technical summary of the program/job. State what the job does and its business purpose.]
@@ -297,7 +562,183 @@ MAINFRAME CODE TO ANALYZE:
 
 Generate technical, accurate documentation:"""
 
-    return prompt
+def create_documentation_prompt(jcl_code: str, proc_code: str, program_code: str) -> str:
+    """Create a structured prompt for LLM documentation generation"""
+    
+    # Keep the head (identification/data divisions) and tail (procedure logic) of oversized sources
+    if len(program_code) > MAX_CODE_BYTES:
+        half = MAX_CODE_BYTES // 2
+        program_code = (
+            f"{program_code[:half]}\n"
+            f"... [TRUNCATED {len(program_code) - MAX_CODE_BYTES} BYTES] ...\n"
+            f"{program_code[-half:]}"
+        )
+    
+    parts = [PROMPT_HEADER]
+    
+    if jcl_code and jcl_code.strip():
+        parts.append(f"JCL CODE:\n{jcl_code}\n\n")
+    
+    if proc_code and proc_code.strip():
+        parts.append(f"PROC CODE:\n{proc_code}\n\n")
+    
+    parts.append(f"PROGRAM CODE:\n{program_code}\n\n")
+    parts.append(PROMPT_FOOTER)
+    
+    return "".join(parts)
+
+def make_cache_key(jcl_code: str, proc_code: str, program_code: str) -> str:
+    """Create a deterministic cache key for a documentation request and the primary model"""
+    raw = orjson.dumps([HF_MODEL_URL, jcl_code or "", proc_code or "", program_code])
+    return hashlib.sha256(raw).hexdigest()
+
+def log_background_failure(task: asyncio.Task):
+    """Log errors from background tasks instead of leaving them unretrieved"""
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error(f"Background task failed: {str(task.exception())}")
+
+def fire_and_forget(coro):
+    """Run a side-effect coroutine without delaying the response"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(log_background_failure)
+
+async def write_batch(collection, batch: List[dict]):
+    """Insert a batch of queued records into a collection"""
+    try:
+        await collection.insert_many(batch, ordered=False)
+    except Exception as e:
+        logging.error(f"Failed to write {len(batch)} record(s) to {collection.name}: {str(e)}")
+
+async def batch_writer(queue: asyncio.Queue, collection):
+    """Collect queued records for up to WRITE_BATCH_WINDOW_MS and write them with one insert_many"""
+    # A None sentinel stops the writer once the records queued ahead of it are written
+    loop = asyncio.get_running_loop()
+    while True:
+        record = await queue.get()
+        if record is None:
+            return
+        batch = [record]
+        stopping = False
+        deadline = loop.time() + WRITE_BATCH_WINDOW_MS / 1000
+        
+        while len(batch) < WRITE_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                record = await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if record is None:
+                stopping = True
+                break
+            batch.append(record)
+        
+        await write_batch(collection, batch)
+        if stopping:
+            return
+
+async def produce_documentation(prompt: str, session: aiohttp.ClientSession) -> Tuple[str, Optional[str]]:
+    """Generate documentation via Hugging Face or rule-based analysis, returning (documentation, model)"""
+    model = None
+    if HF_API_KEY:
+        logging.info(f"Attempting to call HF API with key: {HF_API_KEY[:10]}...")
+        try:
+            documentation, model = await call_hugging_face_api(prompt, session)
+            # If we get a meaningful response, use it
+            if "MAINFRAME DOCUMENTATION" in documentation or len(documentation) > 200:
+                logging.info("Successfully generated LLM documentation")
+            else:
+                raise Exception("LLM response too short, using fallback")
+        except Exception as e:
+            logging.warning(f"LLM failed: {str(e)}, using enhanced fallback")
+            documentation = await asyncio.to_thread(generate_fallback_documentation, prompt)
+            model = None
+    else:
+        logging.warning("No Hugging Face API key provided, using fallback documentation")
+        documentation = await asyncio.to_thread(generate_fallback_documentation, prompt)
+    
+    return documentation, model
+
+async def generate_and_cache(cache_key: str, prompt: str, session: aiohttp.ClientSession) -> str:
+    """Generate documentation and store primary-model output in both cache tiers"""
+    documentation, model = await produce_documentation(prompt, session)
+    
+    # Only cache primary-model output: the key names HF_MODEL_URL, and a recovered
+    # primary should not be masked by fallback-model or rule-based docs
+    if model == HF_MODEL_URL:
+        now = datetime.now(timezone.utc)
+        memory_cache[cache_key] = (documentation, now + timedelta(seconds=CACHE_TTL_SECONDS))
+        fire_and_forget(db.documentation_cache.update_one(
+            {"cache_key": cache_key},
+            {"$set": {
+                "cache_key": cache_key,
+                "documentation": documentation,
+                "timestamp": now
+            }},
+            upsert=True
+        ))
+    
+    return documentation
+
+async def run_deduplicated(cache_key: str, factory):
+    """Await an in-flight generation for cache_key, or start one and share its result"""
+    # No await between lookup and registration, so no lock is needed on the event loop
+    future = inflight_requests.get(cache_key)
+    if future is not None:
+        logging.info(f"Joining in-flight generation: {cache_key[:12]}")
+        return await asyncio.shield(future)
+    
+    future = asyncio.get_running_loop().create_future()
+    inflight_requests[cache_key] = future
+    try:
+        result = await factory()
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        # Mark the exception as retrieved in case nobody joined this generation
+        future.exception()
+        raise
+    finally:
+        if not future.done():
+            future.cancel()
+        inflight_requests.pop(cache_key, None)
+
+async def probe_llm_status(session: aiohttp.ClientSession) -> dict:
+    """Check the API key and model via the HF model metadata endpoint (no inference)"""
+    try:
+        async with session.get(
+            HF_MODEL_INFO_URL,
+            headers=HF_AUTH_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=10)
+        ) as response:
+            status = response.status
+        
+        if status == 200:
+            return {
+                "status": "working",
+                "message": "Model reachable",
+                "model": HF_MODEL_URL.split('/')[-1],
+                "available": True
+            }
+        else:
+            return {
+                "status": "error",
+                "message": f"API error: {status}",
+                "model": HF_MODEL_URL.split('/')[-1], 
+                "available": False
+            }
+            
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": f"Connection error: {str(e)}",
+            "model": HF_MODEL_URL.split('/')[-1] if HF_MODEL_URL else None,
+            "available": False
+        }
 
 @api_router.get("/llm-status")
 async def check_llm_status():
@@ -311,47 +752,29 @@ async def check_llm_status():
             "available": False
         }
     
-    # Quick test of the API key
-    try:
-        headers = {"Authorization": f"Bearer {HF_API_KEY}"}
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            # Test with a simple request
-            response = await client.post(
-                HF_MODEL_URL,
-                headers=headers,
-                json={"inputs": "test"}
-            )
-            
-            if response.status_code == 200:
-                return {
-                    "status": "working",
-                    "message": "Hugging Face API is working",
-                    "model": HF_MODEL_URL.split('/')[-1],
-                    "available": True
-                }
-            elif response.status_code == 503:
-                return {
-                    "status": "loading", 
-                    "message": "Model is loading, please wait",
-                    "model": HF_MODEL_URL.split('/')[-1],
-                    "available": False
-                }
-            else:
-                return {
-                    "status": "error",
-                    "message": f"API error: {response.status_code}",
-                    "model": HF_MODEL_URL.split('/')[-1], 
-                    "available": False
-                }
-                
-    except Exception as e:
-        return {
-            "status": "error",
-            "message": f"Connection error: {str(e)}",
-            "model": HF_MODEL_URL.split('/')[-1] if HF_MODEL_URL else None,
-            "available": False
-        }
-@api_router.post("/generate-documentation", response_model=DocumentationResponse)
+    # Serve recent results so polling frontends do not hit HF on every call
+    if time.monotonic() < llm_status_cache["expires"]:
+        return llm_status_cache["value"]
+    
+    status = await probe_llm_status(app.state.hf_session)
+    llm_status_cache["value"] = status
+    llm_status_cache["expires"] = time.monotonic() + LLM_STATUS_TTL_SECONDS
+    return status
+
+def queue_history_record(request: DocumentationRequest, session_id: str, documentation: str, method: str):
+    """Queue a documentation history record for the batched writer"""
+    app.state.history_queue.put_nowait({
+        "session_id": session_id,
+        "jcl_code": request.jcl_code,
+        "proc_code": request.proc_code,
+        "program_code": request.program_code,
+        "documentation": documentation,
+        "timestamp": datetime.now(timezone.utc),
+        "method": method
+    })
+
+# Responses are built directly to skip re-validating the large documentation body
+@api_router.post("/generate-documentation", responses={200: {"model": DocumentationResponse}})
 async def generate_documentation(request: DocumentationRequest):
     """Generate mainframe documentation using Hugging Face LLM"""
     
@@ -359,67 +782,137 @@ async def generate_documentation(request: DocumentationRequest):
         # Create session ID if not provided
         session_id = request.session_id or str(uuid.uuid4())
         
-        # Create the prompt for LLM
-        prompt = create_documentation_prompt(
+        # Serve identical requests from memory, then from the Mongo documentation cache
+        cache_key = make_cache_key(request.jcl_code, request.proc_code, request.program_code)
+        now = datetime.now(timezone.utc)
+        documentation, expires = memory_cache.get(cache_key, (None, now))
+        if documentation is not None and expires > now:
+            logging.info(f"Documentation memory cache hit: {cache_key[:12]}")
+            queue_history_record(request, session_id, documentation, "cache")
+            return ORJSONResponse({
+                "documentation": documentation,
+                "session_id": session_id
+            })
+        
+        cached = await db.documentation_cache.find_one({"cache_key": cache_key})
+        if cached and cached["timestamp"] > now - timedelta(seconds=CACHE_TTL_SECONDS):
+            logging.info(f"Documentation cache hit: {cache_key[:12]}")
+            # Keep the Mongo entry's expiry so the memory copy cannot outlive it
+            memory_cache[cache_key] = (
+                cached["documentation"],
+                cached["timestamp"] + timedelta(seconds=CACHE_TTL_SECONDS)
+            )
+            queue_history_record(request, session_id, cached["documentation"], "cache")
+            return ORJSONResponse({
+                "documentation": cached["documentation"],
+                "session_id": session_id
+            })
+        
+        # Create the prompt for LLM off the event loop, as large sources make this CPU-bound
+        prompt = await asyncio.to_thread(
+            create_documentation_prompt,
             request.jcl_code or "",
             request.proc_code or "",
             request.program_code
         )
         
-        # Call Hugging Face API or fallback
-        if HF_API_KEY:
-            logging.info(f"Attempting to call HF API with key: {HF_API_KEY[:10]}...")
-            try:
-                documentation = await call_hugging_face_api(prompt)
-                # If we get a meaningful response, use it
-                if "MAINFRAME DOCUMENTATION" in documentation or len(documentation) > 200:
-                    logging.info("Successfully generated LLM documentation")
-                else:
-                    raise Exception("LLM response too short, using fallback")
-            except Exception as e:
-                logging.warning(f"LLM failed: {str(e)}, using enhanced fallback")
-                documentation = generate_fallback_documentation(prompt)
-        else:
-            logging.warning("No Hugging Face API key provided, using fallback documentation")
-            documentation = generate_fallback_documentation(prompt)
+        # Identical requests already in flight share a single generation and cache write
+        documentation = await run_deduplicated(
+            cache_key,
+            lambda: generate_and_cache(cache_key, prompt, app.state.hf_session)
+        )
         
         # Store in database for history
-        doc_record = {
-            "session_id": session_id,
-            "jcl_code": request.jcl_code,
-            "proc_code": request.proc_code,
-            "program_code": request.program_code,
-            "documentation": documentation,
-            "timestamp": datetime.utcnow(),
-            "method": "hugging_face" if HF_API_KEY else "fallback"
-        }
-        
-        await db.documentation_history.insert_one(doc_record)
+        queue_history_record(request, session_id, documentation, "hugging_face" if HF_API_KEY else "fallback")
         
-        return DocumentationResponse(
-            documentation=documentation,
-            session_id=session_id
-        )
+        return ORJSONResponse({
+            "documentation": documentation,
+            "session_id": session_id
+        })
         
     except Exception as e:
         logging.error(f"Error generating documentation: {str(e)}")
         # Return fallback documentation on any error
-        fallback_doc = generate_fallback_documentation("")
-        return DocumentationResponse(
-            documentation=fallback_doc,
-            session_id=request.session_id or str(uuid.uuid4())
-        )
+        return ORJSONResponse({
+            "documentation": DEFAULT_FALLBACK_DOC,
+            "session_id": request.session_id or str(uuid.uuid4())
+        })
 
 # Include the router in the main app
 app.include_router(api_router)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# CORS configuration, parsed once at import
+CORS_ORIGINS = frozenset(os.environ.get('CORS_ORIGINS', '*').split(','))
+CORS_ALLOW_ALL_ORIGINS = "*" in CORS_ORIGINS
+CORS_ALLOW_METHODS = b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"
+
+class CORSHeadersMiddleware:
+    """Minimal pure-ASGI CORS middleware allowing credentials, all methods and all headers"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        origin = request_method = request_headers = None
+        for key, value in scope["headers"]:
+            if key == b"origin":
+                origin = value
+            elif key == b"access-control-request-method":
+                request_method = value
+            elif key == b"access-control-request-headers":
+                request_headers = value
+        
+        if origin is None:
+            await self.app(scope, receive, send)
+            return
+        
+        allowed = CORS_ALLOW_ALL_ORIGINS or origin.decode("latin-1") in CORS_ORIGINS
+        # Credentialed requests require the concrete origin to be echoed back
+        cors_headers = [
+            (b"access-control-allow-origin", origin),
+            (b"access-control-allow-credentials", b"true"),
+            (b"vary", b"Origin")
+        ]
+        
+        if scope["method"] == "OPTIONS" and request_method is not None:
+            # Preflight requests are answered directly
+            if not allowed:
+                status, body, headers = 400, b"Disallowed CORS origin", []
+            else:
+                status, body = 200, b"OK"
+                headers = cors_headers + [
+                    (b"access-control-allow-methods", CORS_ALLOW_METHODS),
+                    (b"access-control-max-age", b"600")
+                ]
+                if request_headers is not None:
+                    headers.append((b"access-control-allow-headers", request_headers))
+            headers += [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode())
+            ]
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+        
+        if not allowed:
+            await self.app(scope, receive, send)
+            return
+        
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + cors_headers
+            await send(message)
+        
+        await self.app(scope, receive, send_with_cors)
+
+app.add_middleware(CORSHeadersMiddleware)
+
+# Compress larger responses such as generated documentation
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 # Configure logging
 logging.basicConfig(
@@ -428,6 +921,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+async def create_db_indexes():
+    await db.documentation_cache.create_index("cache_key", unique=True)
+    await db.status_checks.create_index([("timestamp", -1)])
+    await db.documentation_history.create_index("session_id")
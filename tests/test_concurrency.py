@@ -0,0 +1,298 @@
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import orjson
+import pytest
+from starlette.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+PRIMARY = server.HF_MODEL_URL
+LLM_DOC = "=== MAINFRAME DOCUMENTATION ===\n" + "x" * 300
+
+
+class FakeCollection:
+    def __init__(self, name):
+        self.name = name
+        self.inserted = []
+        self.documents = {}
+        self.upserts = 0
+
+    async def insert_many(self, records, ordered=True):
+        self.inserted.extend(records)
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    async def find_one(self, query):
+        return self.documents.get(query["cache_key"])
+
+    async def update_one(self, query, update, upsert=False):
+        self.upserts += 1
+        self.documents[query["cache_key"]] = update["$set"]
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, FakeCollection(name))
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeDatabase()
+    monkeypatch.setattr(server, "db", db)
+    server.memory_cache.clear()
+    server.inflight_requests.clear()
+    yield db
+    server.memory_cache.clear()
+
+
+@pytest.fixture
+def fake_models(monkeypatch):
+    """Replace model attempts with per-model coroutines and record which models were started"""
+    started = []
+    behaviours = {}
+
+    async def try_model(prompt, payload, session, model):
+        started.append(model)
+        return await behaviours[model]()
+
+    monkeypatch.setattr(server, "try_hugging_face_model", try_model)
+    monkeypatch.setattr(server, "HF_HEDGE_SECONDS", 0.05)
+    return started, behaviours
+
+
+def answer(doc, delay=0.0):
+    async def behaviour():
+        await asyncio.sleep(delay)
+        return doc
+    return behaviour
+
+
+def hang():
+    return answer(None, delay=100)
+
+
+def test_lifespan_runs_twice_and_drains_writes(fake_db):
+    # Each TestClient context runs the lifespan on a fresh event loop
+    for run in range(2):
+        with TestClient(server.app) as client:
+            for i in range(3):
+                client.post("/api/status", json={"client_name": f"run{run}-{i}"})
+
+        assert server.app.state.hf_batch_task.cancelled()
+
+    names = [record["client_name"] for record in fake_db.status_checks.inserted]
+    assert names == [f"run{run}-{i}" for run in range(2) for i in range(3)]
+
+
+def test_batch_writer_writes_records_queued_before_sentinel():
+    collection = FakeCollection("history")
+
+    async def run():
+        queue = asyncio.Queue()
+        for i in range(5):
+            queue.put_nowait({"n": i})
+        queue.put_nowait(None)
+        await server.batch_writer(queue, collection)
+
+    asyncio.run(run())
+
+    assert [record["n"] for record in collection.inserted] == list(range(5))
+
+
+def test_run_deduplicated_shares_one_result():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "doc"
+
+    async def run():
+        return await asyncio.gather(*[server.run_deduplicated("key", factory) for _ in range(4)])
+
+    assert asyncio.run(run()) == ["doc"] * 4
+    assert len(calls) == 1
+    assert server.inflight_requests == {}
+
+
+def test_run_deduplicated_shares_one_error():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run():
+        return await asyncio.gather(
+            *[server.run_deduplicated("key", factory) for _ in range(3)],
+            return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    assert server.inflight_requests == {}
+
+
+def test_healthy_primary_answers_alone(fake_models):
+    started, behaviours = fake_models
+    behaviours[PRIMARY] = answer("primary doc", delay=0.01)
+
+    documentation, model = asyncio.run(server.call_hugging_face_api("prompt", None))
+
+    assert (documentation, model) == ("primary doc", PRIMARY)
+    assert started == [PRIMARY]
+
+
+def test_failed_primary_starts_fallback_immediately(fake_models):
+    started, behaviours = fake_models
+    behaviours[PRIMARY] = answer(None)
+    behaviours[server.FALLBACK_MODELS[0]] = answer("fallback doc")
+
+    documentation, model = asyncio.run(server.call_hugging_face_api("prompt", None))
+
+    assert (documentation, model) == ("fallback doc", server.FALLBACK_MODELS[0])
+    assert started == [PRIMARY, server.FALLBACK_MODELS[0]]
+
+
+def test_slow_primary_is_hedged_and_preferred_when_finishing_together(fake_models):
+    started, behaviours = fake_models
+    release = None
+
+    def wait_for_release(doc):
+        async def behaviour():
+            await release.wait()
+            return doc
+        return behaviour
+
+    behaviours[PRIMARY] = wait_for_release("primary doc")
+    for fallback in server.FALLBACK_MODELS:
+        behaviours[fallback] = wait_for_release(f"doc from {fallback}")
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.3, release.set)
+        return await server.call_hugging_face_api("prompt", None)
+
+    documentation, model = asyncio.run(run())
+
+    assert started == [PRIMARY] + server.FALLBACK_MODELS
+    assert (documentation, model) == ("primary doc", PRIMARY)
+
+
+def test_deadline_falls_back_to_rule_based_doc(fake_models, monkeypatch):
+    started, behaviours = fake_models
+    monkeypatch.setattr(server, "HF_DEADLINE_SECONDS", 0.3)
+    for model in [PRIMARY] + server.FALLBACK_MODELS:
+        behaviours[model] = hang()
+
+    async def run():
+        result = await server.call_hugging_face_api("PROGRAM-ID. PAYROLL", None)
+        # Outstanding attempts were cancelled rather than left running
+        await asyncio.sleep(0)
+        return result, len(asyncio.all_tasks())
+
+    (documentation, model), running = asyncio.run(run())
+
+    assert model is None
+    assert "RULE-BASED ANALYSIS" in documentation
+    assert "PAYROLL" in documentation
+    assert running == 1
+
+
+def test_unresolved_batch_fails_over_to_fallback(monkeypatch):
+    monkeypatch.setattr(server, "HF_TIMEOUT_SECONDS", 0.1)
+
+    async def post(session, model, payload):
+        return 200, b'[{"generated_text": "1. Overview from fallback"}]'
+
+    monkeypatch.setattr(server, "post_to_hugging_face", post)
+
+    async def run():
+        # No batch worker consumes the queue, so the primary future never resolves
+        server.app.state.hf_batch_queue = asyncio.Queue()
+        return await server.call_hugging_face_api("prompt", None)
+
+    documentation, model = asyncio.run(run())
+
+    assert model == server.FALLBACK_MODELS[0]
+    assert "Overview from fallback" in documentation
+
+
+def generate(requests):
+    async def run():
+        server.app.state.history_queue = asyncio.Queue()
+        server.app.state.hf_session = None
+        responses = await asyncio.gather(*[server.generate_documentation(request) for request in requests])
+        # Let fire-and-forget cache writes finish
+        await asyncio.sleep(0)
+        return responses, server.app.state.history_queue
+
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def fake_hf(monkeypatch):
+    calls = []
+
+    async def call_hf(prompt, session):
+        calls.append(prompt)
+        await asyncio.sleep(0.01)
+        return LLM_DOC, PRIMARY
+
+    monkeypatch.setattr(server, "HF_API_KEY", "test-key")
+    monkeypatch.setattr(server, "call_hugging_face_api", call_hf)
+    return calls
+
+
+def test_duplicate_requests_generate_and_cache_once(fake_db, fake_hf):
+    request = server.DocumentationRequest(program_code="PROGRAM-ID. DUP")
+
+    responses, history = generate([request] * 4)
+
+    assert all(orjson.loads(response.body)["documentation"] == LLM_DOC for response in responses)
+    assert len(fake_hf) == 1
+    assert fake_db.documentation_cache.upserts == 1
+    assert history.qsize() == 4
+
+
+def test_memory_cache_keeps_mongo_expiry(fake_db, fake_hf):
+    request = server.DocumentationRequest(program_code="PROGRAM-ID. OLD")
+    cache_key = server.make_cache_key(None, None, request.program_code)
+    stored = datetime.now(timezone.utc) - timedelta(seconds=server.CACHE_TTL_SECONDS - 60)
+    fake_db.documentation_cache.documents[cache_key] = {
+        "cache_key": cache_key,
+        "documentation": "cached doc",
+        "timestamp": stored
+    }
+
+    responses, history = generate([request])
+
+    assert orjson.loads(responses[0].body)["documentation"] == "cached doc"
+    assert fake_hf == []
+    assert server.memory_cache[cache_key] == ("cached doc", stored + timedelta(seconds=server.CACHE_TTL_SECONDS))
+    assert history.get_nowait()["method"] == "cache"
+
+
+def test_expired_memory_entry_is_not_served(fake_db, fake_hf):
+    request = server.DocumentationRequest(program_code="PROGRAM-ID. EXP")
+    cache_key = server.make_cache_key(None, None, request.program_code)
+    server.memory_cache[cache_key] = ("stale doc", datetime.now(timezone.utc) - timedelta(seconds=1))
+
+    responses, _ = generate([request])
+
+    assert orjson.loads(responses[0].body)["documentation"] == LLM_DOC
+    assert len(fake_hf) == 1
+    assert fake_db.documentation_cache.upserts == 1
@@ -0,0 +1,102 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from server import CORSHeadersMiddleware  # noqa: E402
+
+ALLOWED_ORIGIN = "https://allowed.example"
+DISALLOWED_ORIGIN = "https://evil.example"
+
+
+@pytest.fixture
+def cors_client(monkeypatch):
+    monkeypatch.setattr(server, "CORS_ORIGINS", frozenset([ALLOWED_ORIGIN]))
+    monkeypatch.setattr(server, "CORS_ALLOW_ALL_ORIGINS", False)
+
+    async def homepage(request):
+        return PlainTextResponse("hello")
+
+    app = Starlette(routes=[Route("/", homepage, methods=["GET", "POST"])])
+    app.add_middleware(CORSHeadersMiddleware)
+    return TestClient(app)
+
+
+def test_preflight_from_allowed_origin(cors_client):
+    response = cors_client.options("/", headers={
+        "Origin": ALLOWED_ORIGIN,
+        "Access-Control-Request-Method": "POST",
+        "Access-Control-Request-Headers": "content-type,x-custom"
+    })
+
+    assert response.status_code == 200
+    assert response.headers["access-control-allow-origin"] == ALLOWED_ORIGIN
+    assert response.headers["access-control-allow-credentials"] == "true"
+    assert "POST" in response.headers["access-control-allow-methods"]
+    assert response.headers["access-control-allow-headers"] == "content-type,x-custom"
+    assert response.headers["access-control-max-age"] == "600"
+    assert response.headers["vary"] == "Origin"
+
+
+def test_preflight_from_disallowed_origin(cors_client):
+    response = cors_client.options("/", headers={
+        "Origin": DISALLOWED_ORIGIN,
+        "Access-Control-Request-Method": "POST"
+    })
+
+    assert response.status_code == 400
+    assert response.text == "Disallowed CORS origin"
+    assert "access-control-allow-origin" not in response.headers
+
+
+def test_simple_request_from_allowed_origin(cors_client):
+    response = cors_client.get("/", headers={"Origin": ALLOWED_ORIGIN})
+
+    assert response.status_code == 200
+    assert response.text == "hello"
+    assert response.headers["access-control-allow-origin"] == ALLOWED_ORIGIN
+    assert response.headers["access-control-allow-credentials"] == "true"
+    assert response.headers["vary"] == "Origin"
+
+
+def test_simple_request_from_disallowed_origin(cors_client):
+    response = cors_client.get("/", headers={"Origin": DISALLOWED_ORIGIN})
+
+    assert response.status_code == 200
+    assert "access-control-allow-origin" not in response.headers
+    assert "access-control-allow-credentials" not in response.headers
+
+
+def test_request_without_origin(cors_client):
+    response = cors_client.get("/")
+
+    assert response.status_code == 200
+    assert response.text == "hello"
+    assert "access-control-allow-origin" not in response.headers
+    assert "vary" not in response.headers
+
+
+def test_non_http_scope_passes_through():
+    calls = []
+
+    async def inner_app(scope, receive, send):
+        calls.append((scope, receive, send))
+
+    async def receive():
+        return {}
+
+    async def send(message):
+        pass
+
+    scope = {"type": "lifespan"}
+    asyncio.run(CORSHeadersMiddleware(inner_app)(scope, receive, send))
+
+    assert calls == [(scope, receive, send)]